@@ -2,11 +2,11 @@
 import ctranslate2
 import transformers
 from docx import Document
-from tqdm import tqdm
 from configparser import ConfigParser
 import pandas as pd
 import threading
 from openpyxl import load_workbook
+from utils.logging_config import logger
 
 cfg = ConfigParser()
 cfg.read('./config/config.ini')
@@ -17,31 +17,63 @@ class TranslatorSingleton:
     _cuda_instances = []
     _tokenizers = {}
     _lock = threading.Lock()
+    _languages = frozenset()
+    _max_batch_tokens = cfg["DEFAULT"].getint("MAX_BATCH_TOKENS", 2048)
+
+    @classmethod
+    def is_language_supported(cls, lang: str) -> bool:
+        return lang in cls._languages
+
+    @classmethod
+    def load_supported_languages(cls):
+        # Take the language codes from the configured model's tokenizer so the check matches what it can translate
+        tokenizer = cls._load_tokenizer("eng_Latn")
+        cls._languages = frozenset(tokenizer.additional_special_tokens)
+        logger.info("Loaded %d supported language codes", len(cls._languages))
 
     @classmethod
     def initialize_models(cls, num_cpu_models=2, num_cuda_models=2):
+        # Give each CPU instance 4 parallel single-threaded workers, dropping to 2 once more instances share the cores
+        cpu_workers = 4 if num_cpu_models <= 2 else 2
+        logger.info("Using %d parallel workers per CPU translator instance", cpu_workers)
         for _ in range(num_cpu_models):
             cls._cpu_instances.append({
                 "translator": ctranslate2.Translator(cfg["MODEL_LIST"][cfg["DEFAULT"]["SEQ_TRANSLATE_MODEL"]],
-                                                     inter_threads=4,
+                                                     compute_type=cfg["DEFAULT"].get("CPU_COMPUTE_TYPE", "default"),
+                                                     inter_threads=cpu_workers,
                                                      intra_threads=1),
                 "task_count": threading.Semaphore(10)
             })
+        # Place a replica on every visible GPU; CT2 spreads the sub-batches of each call across them
+        cuda_devices = list(range(max(ctranslate2.get_cuda_device_count(), 1)))
+        logger.info("Using CUDA devices %s per CUDA translator instance", cuda_devices)
         for _ in range(num_cuda_models):
             cls._cuda_instances.append({
                 "translator": ctranslate2.Translator(cfg["MODEL_LIST"][cfg["DEFAULT"]["FILE_TRANSLATE_MODEL"]],
-                                                     device='cuda'),
+                                                     device='cuda',
+                                                     device_index=cuda_devices,
+                                                     compute_type=cfg["DEFAULT"].get("CUDA_COMPUTE_TYPE", "default"),
+                                                     # Workers per GPU, each on its own CUDA stream sharing that GPU's weights
+                                                     inter_threads=cfg["DEFAULT"].getint("CUDA_INTER_THREADS", 1)),
                 "task_count": threading.Semaphore(10)
             })
 
     @classmethod
     def _load_tokenizer(cls, src_lang: str):
-        if (src_lang, "tokenizer") not in cls._tokenizers:
-            cls._tokenizers[(src_lang, "tokenizer")] = transformers.AutoTokenizer.from_pretrained(
-                cfg["TOKENIZER_LIST"][cfg["DEFAULT"]["SEQ_TRANSLATE_MODEL"]],
-                src_lang=src_lang
-            )
-        return cls._tokenizers[(src_lang, "tokenizer")]
+        tokenizer = cls._tokenizers.get((src_lang, "tokenizer"))
+        if tokenizer is None:
+            # Translations run on several worker threads; load each tokenizer only once
+            with cls._lock:
+                if (src_lang, "tokenizer") not in cls._tokenizers:
+                    cls._tokenizers[(src_lang, "tokenizer")] = transformers.AutoTokenizer.from_pretrained(
+                        cfg["TOKENIZER_LIST"][cfg["DEFAULT"]["SEQ_TRANSLATE_MODEL"]],
+                        src_lang=src_lang,
+                        use_fast=True
+                    )
+                    if not cls._tokenizers[(src_lang, "tokenizer")].is_fast:
+                        logger.warning("No fast tokenizer available for %s, falling back to the slow one", src_lang)
+                tokenizer = cls._tokenizers[(src_lang, "tokenizer")]
+        return tokenizer
 
     @classmethod
     def _get_least_loaded_model(cls, use_cuda=False):
@@ -55,83 +87,65 @@ class TranslatorSingleton:
         model_instance["task_count"].release()
 
     @classmethod
-    def translate_sentence(cls, text: str, src_lang: str, tgt_lang: str, use_cuda=False, via_eng=False) -> str:
-        if via_eng and src_lang != "eng_Latn" and tgt_lang != "eng_Latn":
-            # First translate to English
-            intermediate_text = cls.translate_sentence(text, src_lang, "eng_Latn", use_cuda)
-            # Then translate from English to target language
-            return cls.translate_sentence(intermediate_text, "eng_Latn", tgt_lang, use_cuda)
-
-        model_instance = cls._get_least_loaded_model(use_cuda)
-        try:
-            translator = model_instance["translator"]
-            tokenizer = cls._load_tokenizer(src_lang)
-
-            source = tokenizer.convert_ids_to_tokens(tokenizer.encode(text))
-            target_prefix = [tgt_lang]
-            results = translator.translate_iterable([source], target_prefix=[target_prefix], beam_size=1)
+    def _translate_tokens(cls, translator, sources: list, tgt_lang: str) -> list:
+        target_prefix = [[tgt_lang]] * len(sources)
+        # translate_batch sorts the inputs by length before splitting them into sub-batches
+        # of at most MAX_BATCH_TOKENS tokens, so padding stays low and a sub-batch of short lines
+        # is as large as the memory budget allows; results come back in the original order
+        results = translator.translate_batch(sources, target_prefix=target_prefix, beam_size=1,
+                                             max_batch_size=cls._max_batch_tokens,
+                                             batch_type="tokens")
+        # Get the first hypothesis, skipping the language tag
+        return [result.hypotheses[0][1:] for result in results]
 
-            translations = []
-            for result in results:
-                target = result.hypotheses[0][1:]  # Get the first hypothesis, skipping the language tag
-                translation = tokenizer.decode(tokenizer.convert_tokens_to_ids(target))
-                translations.append(translation)
-
-            return translations[0]
-
-        finally:
-            cls._release_model(model_instance)
+    @classmethod
+    def translate_sentence(cls, text: str, src_lang: str, tgt_lang: str, use_cuda=False, via_eng=False) -> str:
+        return cls.translate_batch([text], src_lang, tgt_lang, use_cuda=use_cuda, via_eng=via_eng)[0]
 
     @classmethod
     def translate_batch(cls, texts: list, src_lang: str, tgt_lang: str, use_cuda=False, via_eng=False) -> list:
-        if via_eng and src_lang != "eng_Latn" and tgt_lang != "eng_Latn":
-            # First translate to English
-            intermediate_texts = cls.translate_batch(texts, src_lang, "eng_Latn", use_cuda)
-            # Then translate from English to target language
-            return cls.translate_batch(intermediate_texts, "eng_Latn", tgt_lang, use_cuda)
+        if not texts:
+            return []
+
+        # Blank lines are passed through and repeated lines (table headers, boilerplate) are translated
+        # only once, without spending model time on them
+        unique_texts = list(dict.fromkeys(text for text in texts if text.strip()))
+        if len(unique_texts) < len(texts):
+            translations = dict(zip(unique_texts, cls.translate_batch(unique_texts, src_lang, tgt_lang,
+                                                                      use_cuda, via_eng)))
+            return [translations.get(text, "") for text in texts]
 
         model_instance = cls._get_least_loaded_model(use_cuda)
         try:
             translator = model_instance["translator"]
             tokenizer = cls._load_tokenizer(src_lang)
 
-            sources = [tokenizer.convert_ids_to_tokens(tokenizer.encode(text)) for text in texts]
-            target_prefix = [tgt_lang] * len(texts)
-            results_generator = translator.translate_iterable(sources, target_prefix=[target_prefix], beam_size=1, max_batch_size=32, asynchronous=True)
-
-            translations = []
-            for result in results_generator:
-                target = result.hypotheses[0][1:]  # Get the first hypothesis, skipping the language tag
-                translation = tokenizer.decode(tokenizer.convert_tokens_to_ids(target))
-                translations.append(translation)
-
-            return translations
+            # Tokenize the whole batch in one call so the fast tokenizer encodes it in Rust, outside the GIL
+            sources = [tokenizer.convert_ids_to_tokens(ids) for ids in tokenizer(texts).input_ids]
+            if via_eng and src_lang != "eng_Latn" and tgt_lang != "eng_Latn":
+                # First translate to English, then feed the English tokens straight back in as the
+                # source of the second pass instead of decoding to text and re-tokenizing; wrap them in the
+                # English tokenizer's own special tokens so legacy and current NLLB layouts both match
+                eng_tokenizer = cls._load_tokenizer("eng_Latn")
+                prefix = eng_tokenizer.convert_ids_to_tokens(eng_tokenizer.prefix_tokens)
+                suffix = eng_tokenizer.convert_ids_to_tokens(eng_tokenizer.suffix_tokens)
+                intermediate = cls._translate_tokens(translator, sources, "eng_Latn")
+                sources = [prefix + target + suffix for target in intermediate]
+
+            targets = cls._translate_tokens(translator, sources, tgt_lang)
+            return [tokenizer.decode(tokenizer.convert_tokens_to_ids(target)) for target in targets]
         finally:
             cls._release_model(model_instance)
 
 
 class DocxTranslator(TranslatorSingleton):
     @staticmethod
-    def translate_run(run, src_lang, tgt_lang, via_eng=False):
-        if not run.text.strip():
-            return ""
-
-        translated_text = TranslatorSingleton.translate_sentence(text=run.text,
-                                                              src_lang=src_lang,
-                                                              tgt_lang=tgt_lang,
-                                                              use_cuda=True,
-                                                              via_eng=via_eng)
-        return translated_text
-
-    @staticmethod
-    def translate_paragraph(paragraph, src_lang, tgt_lang, via_eng=False):
+    def translate_paragraph(paragraph, translated_texts):
+        """Rewrite the runs of a paragraph, taking translations for its non-empty runs from an iterator"""
         translated_runs = []
 
         for run in paragraph.runs:
-            translated_text = DocxTranslator.translate_run(run=run,
-                                                           src_lang=src_lang,
-                                                           tgt_lang=tgt_lang,
-                                                           via_eng=via_eng)
+            translated_text = next(translated_texts) if run.text.strip() else ""
             translated_runs.append((translated_text, run))
 
         paragraph.clear()
@@ -148,58 +162,90 @@ class DocxTranslator(TranslatorSingleton):
             translated_run.font.highlight_color = original_run.font.highlight_color
 
     @staticmethod
-    def translate_docx(input_path: str, output_path: str, src_lang: str, tgt_lang: str, via_eng=False):
-        doc = Document(input_path)
+    def load_docx(input_path: str):
+        return Document(input_path)
+
+    @staticmethod
+    def translate_document(doc, src_lang: str, tgt_lang: str, via_eng=False):
         translated_doc = Document()
 
-        for para in tqdm(doc.paragraphs, desc=f"Translating {input_path}"):
-            if para.text.strip():
-                DocxTranslator.translate_paragraph(paragraph=para,
-                                                   src_lang=src_lang,
-                                                   tgt_lang=tgt_lang,
-                                                   via_eng=via_eng)
-                translated_doc.add_paragraph(para.text)
+        paragraphs = [para for para in doc.paragraphs if para.text.strip()]
+        # Translate every non-empty run of the document in a single batch rather than one run at a time
+        texts = [run.text for para in paragraphs for run in para.runs if run.text.strip()]
+        translated_texts = iter(TranslatorSingleton.translate_batch(texts=texts,
+                                                                    src_lang=src_lang,
+                                                                    tgt_lang=tgt_lang,
+                                                                    use_cuda=True,
+                                                                    via_eng=via_eng))
+
+        for para in paragraphs:
+            DocxTranslator.translate_paragraph(paragraph=para, translated_texts=translated_texts)
+            translated_doc.add_paragraph(para.text)
 
+        return translated_doc
+
+    @staticmethod
+    def save_docx(translated_doc, output_path: str):
         translated_doc.save(output_path)
 
+    @staticmethod
+    def translate_docx(input_path: str, output_path: str, src_lang: str, tgt_lang: str, via_eng=False):
+        doc = DocxTranslator.load_docx(input_path)
+        translated_doc = DocxTranslator.translate_document(doc, src_lang=src_lang, tgt_lang=tgt_lang, via_eng=via_eng)
+        DocxTranslator.save_docx(translated_doc, output_path)
+
 
 class TableTranslator(TranslatorSingleton):
     @staticmethod
-    def translate_text(text, src_lang, tgt_lang, via_eng=False):
-        if text is None:
-            return text
-        lines = text.split('\n')
-        translated_lines = TranslatorSingleton.translate_batch(texts=lines,
-                                                               src_lang=src_lang,
-                                                               tgt_lang=tgt_lang,
-                                                               use_cuda=True,
-                                                               via_eng=via_eng)
-        return '\n'.join(translated_lines)
+    def translate_texts(texts, src_lang, tgt_lang, via_eng=False):
+        """Translate a list of (possibly multi-line) cell values with a single model call"""
+        cell_lines = [text.split('\n') for text in texts]
+        translated_lines = iter(TranslatorSingleton.translate_batch(texts=[line for cell in cell_lines for line in cell],
+                                                                    src_lang=src_lang,
+                                                                    tgt_lang=tgt_lang,
+                                                                    use_cuda=True,
+                                                                    via_eng=via_eng))
+        return ['\n'.join(next(translated_lines) for _ in cell) for cell in cell_lines]
 
     @staticmethod
-    def translate_excel(input_path: str, output_path: str, src_lang: str, tgt_lang: str, via_eng=False):
-        wb = load_workbook(input_path)
+    def load_excel(input_path: str):
+        return load_workbook(input_path)
 
+    @staticmethod
+    def translate_workbook(wb, src_lang: str, tgt_lang: str, via_eng=False):
+        # Collect the text cells of every sheet first so the whole workbook goes to the model in one batch
+        sheet_cells = []
+        texts = []
         for sheet in wb.worksheets:
-            # Dictionary to store merged cell ranges and their translated content
-            translated_cells = {}
+            coords = []
             for row in sheet.iter_rows():
                 for cell in row:
                     if cell.value and isinstance(cell.value, str):
-                        # Translate the text only if this cell is the first in a merged range or not merged
-                        if cell.coordinate not in translated_cells:
-                            translated_text = TableTranslator.translate_text(text=cell.value,
-                                                                             src_lang=src_lang,
-                                                                             tgt_lang=tgt_lang,
-                                                                             via_eng=via_eng)
-                            translated_cells[cell.coordinate] = translated_text
-
-                            # Apply the translation to all cells in the merged range, if any
-                            for merged_range in sheet.merged_cells.ranges:
-                                if cell.coordinate in merged_range:
-                                    for row in sheet[merged_range.coord]:
-                                        for merged_cell in row:
-                                            translated_cells[merged_cell.coordinate] = translated_text
+                        coords.append(cell.coordinate)
+                        texts.append(cell.value)
+            sheet_cells.append((sheet, coords))
+
+        translated_texts = iter(TableTranslator.translate_texts(texts=texts,
+                                                                src_lang=src_lang,
+                                                                tgt_lang=tgt_lang,
+                                                                via_eng=via_eng))
+
+        for sheet, coords in sheet_cells:
+            # Dictionary to store merged cell ranges and their translated content
+            translated_cells = {}
+            for coord in coords:
+                translated_text = next(translated_texts)
+                # Keep the translation only if this cell is the first in a merged range or not merged
+                if coord in translated_cells:
+                    continue
+                translated_cells[coord] = translated_text
+
+                # Apply the translation to all cells in the merged range, if any
+                for merged_range in sheet.merged_cells.ranges:
+                    if coord in merged_range:
+                        for row in sheet[merged_range.coord]:
+                            for merged_cell in row:
+                                translated_cells[merged_cell.coordinate] = translated_text
 
             # Apply translated values back to the worksheet
             for coord, translated_text in translated_cells.items():
@@ -209,14 +255,38 @@ class TableTranslator(TranslatorSingleton):
             for merged_cell in sheet.merged_cells.ranges:
                 sheet.merge_cells(str(merged_cell))
 
+        return wb
+
+    @staticmethod
+    def save_excel(wb, output_path: str):
         wb.save(output_path)
 
     @staticmethod
-    def translate_csv(input_path: str, output_path: str, src_lang: str, tgt_lang: str, via_eng=False):
-        df = pd.read_csv(input_path)
-        translated_df = df.applymap(
-            lambda x: TableTranslator.translate_text(text=x,
-                                                     src_lang=src_lang,
-                                                     tgt_lang=tgt_lang,
-                                                     via_eng=via_eng) if isinstance(x, str) else x)
+    def translate_excel(input_path: str, output_path: str, src_lang: str, tgt_lang: str, via_eng=False):
+        wb = TableTranslator.load_excel(input_path)
+        TableTranslator.translate_workbook(wb, src_lang=src_lang, tgt_lang=tgt_lang, via_eng=via_eng)
+        TableTranslator.save_excel(wb, output_path)
+
+    @staticmethod
+    def load_csv(input_path: str):
+        return pd.read_csv(input_path)
+
+    @staticmethod
+    def translate_dataframe(df, src_lang: str, tgt_lang: str, via_eng=False):
+        # Translate each distinct string cell once, in a single batch, instead of one model call per cell
+        texts = list(dict.fromkeys(x for x in df.to_numpy().ravel() if isinstance(x, str)))
+        translations = dict(zip(texts, TableTranslator.translate_texts(texts=texts,
+                                                                       src_lang=src_lang,
+                                                                       tgt_lang=tgt_lang,
+                                                                       via_eng=via_eng)))
+        return df.applymap(lambda x: translations[x] if isinstance(x, str) else x)
+
+    @staticmethod
+    def save_csv(translated_df, output_path: str):
         translated_df.to_csv(output_path, index=False)
+
+    @staticmethod
+    def translate_csv(input_path: str, output_path: str, src_lang: str, tgt_lang: str, via_eng=False):
+        df = TableTranslator.load_csv(input_path)
+        translated_df = TableTranslator.translate_dataframe(df, src_lang=src_lang, tgt_lang=tgt_lang, via_eng=via_eng)
+        TableTranslator.save_csv(translated_df, output_path)
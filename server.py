@@ -1,50 +1,104 @@
-import json
 import os
+import re
+import asyncio
+import orjson
 import uuid
+import mimetypes
 import torch.cuda
 import uvicorn
 from utils.logging_config import logger
 from pathlib import Path
-from zipfile import ZipFile
+from itertools import chain
+from urllib.parse import quote
+from zipfile import ZIP_STORED
+from zipstream import ZipStream
 from configparser import ConfigParser
 from typing import List
 from docx.opc.exceptions import PackageNotFoundError
 from fastapi import FastAPI, WebSocket, File, UploadFile, HTTPException, Request, BackgroundTasks
 from fastapi.middleware.cors import CORSMiddleware
-from fastapi.responses import JSONResponse, FileResponse
-from service.translate import translate_sentences, translate_folder_with_task_id
+from fastapi.responses import ORJSONResponse, StreamingResponse
+from service.translate import translate_lines, translate_folder_with_task_id
 from utils.taskManager import task_manager, TaskStatus
 from utils.rateLimiter import rate_limiter, ws_rate_limiter
+from utils.batcher import batcher
 from utils.fileHandler import FileHandler
 from contextlib import asynccontextmanager
 from models.model import *
 from models.translateModel import TranslatorSingleton
-from utils.util import delete_folder_contents
+from utils.util import delete_folder_contents, iter_files
 from utils.cronjob import scheduler
 
 config = ConfigParser()  # 创建配置解析器对象
+# 任务ID即上传时生成的uuid4，会被拼接进文件路径，使用前必须校验格式
+TASK_ID_PATTERN = re.compile(r"[0-9a-f]{8}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{12}")
+
+
+def check_task_id(task_id: str):
+    if not task_id or not TASK_ID_PATTERN.fullmatch(task_id):
+        raise HTTPException(status_code=400, detail="Invalid task id")
+
+
+def is_language_pair_supported(src_lang: str, tgt_lang: str) -> bool:
+    return TranslatorSingleton.is_language_supported(src_lang) and TranslatorSingleton.is_language_supported(tgt_lang)
+
+
+def mark_downloaded(task_id: str):
+    # 服务重启后内存中已没有该任务，文件照常发送，只是无需再更新状态
+    try:
+        task_manager.update_task_status(task_id, TaskStatus.DOWNLOADED)
+    except ValueError:
+        logger.warning("Downloaded task %s is not tracked, status not updated", task_id)
+
+
+def iter_then_mark_downloaded(chunks, task_id: str):
+    # 最后一块数据发送完成后才标记为已下载；客户端中途断开时生成器不会继续执行，任务保持可重新下载
+    yield from chunks
+    mark_downloaded(task_id)
+
+
+def iter_file(path: str):
+    with open(path, "rb") as f:
+        while chunk := f.read(1 << 20):
+            yield chunk
+
 
 @asynccontextmanager
 async def lifespan(app: FastAPI):
     # 预加载配置项
     config.read(os.path.abspath("./config/config.ini"))
+    app.state.upload_dir = Path(config['DEFAULT']['UPLOAD_DIRECTORY']).resolve()
+    app.state.upload_dir.mkdir(parents=True, exist_ok=True)
+    app.state.download_dir = Path(config['DEFAULT']['DOWNLOAD_DICTIONARY']).resolve()
+    app.state.max_tasks = int(config['DEFAULT']['MAX_TASKS'])
+    app.state.max_file_size = config['DEFAULT'].getint('MAX_FILE_SIZE_MB', 100) * 1024 * 1024
     # 预加载模型
     TranslatorSingleton.initialize_models(num_cpu_models=1, num_cuda_models=1)
     # 预加载tokenizer
     TranslatorSingleton._load_tokenizer("khk_Cyrl")
     TranslatorSingleton._load_tokenizer("eng_Latn")
+    # 支持的语言代码取自已加载的tokenizer
+    TranslatorSingleton.load_supported_languages()
+    # 预热模型，让首个请求不再承担设备初始化和内存池分配的开销
+    for src_lang, tgt_lang in [("eng_Latn", "khk_Cyrl"), ("khk_Cyrl", "eng_Latn")]:
+        for use_cuda in (False, True):
+            await asyncio.to_thread(TranslatorSingleton.translate_batch, ["warmup sentence."], src_lang, tgt_lang,
+                                    use_cuda=use_cuda)
     # 定时任务
     scheduler.add_job(task_manager.delete_downloaded_task_folders, 'cron', hour=12, minute=7,
-                      args=[config['DEFAULT']['DOWNLOAD_DICTIONARY']])
+                      args=[str(app.state.download_dir)])
     scheduler.start()
+    # 动态批处理
+    batcher.start(translate_lines)
     yield
+    await batcher.stop()
     scheduler.shutdown()
     if torch.cuda.is_available():
         torch.cuda.empty_cache()
         torch.cuda.ipc_collect()
 
 
-app = FastAPI(lifespan=lifespan)
+app = FastAPI(lifespan=lifespan, default_response_class=ORJSONResponse)
 app.add_middleware(
     CORSMiddleware,
     allow_origins=["*"],  # 允许所有源
@@ -60,17 +114,17 @@ app.add_middleware(
 async def create_upload_files(files: List[UploadFile] = File(...)):
     # client_ip = request.client.host
     client_ip = str(uuid.uuid4())
-    user_directory = os.path.join(os.path.abspath(config['DEFAULT']['UPLOAD_DIRECTORY']), client_ip)
+    user_directory = str(app.state.upload_dir / client_ip)
     try:
-        FileHandler.process_files(user_directory, files)
-        logger.info(f"Successfully uploaded and processed {len(files)} files from {client_ip}.")
+        await FileHandler.process_files(user_directory, files, app.state.max_file_size)
+        logger.info("Successfully uploaded and processed %d files from %s.", len(files), client_ip)
     except HTTPException as e:
-        logger.error(f"{client_ip} upload failed , {e.detail}.")
-        return JSONResponse(status_code=e.status_code, content={"message": e.detail})
+        logger.error("%s upload failed , %s.", client_ip, e.detail)
+        return ORJSONResponse(status_code=e.status_code, content={"message": e.detail})
 
-    return JSONResponse(status_code=200,
-                        content={"client_id": client_ip,
-                                 "message": f"Successfully uploaded and processed {len(files)} files."})
+    return ORJSONResponse(status_code=200,
+                          content={"client_id": client_ip,
+                                   "message": f"Successfully uploaded and processed {len(files)} files."})
 
 
 # 批量翻译
@@ -78,14 +132,18 @@ async def create_upload_files(files: List[UploadFile] = File(...)):
 async def translate_files(request: Request, args: SourceRequest, background_tasks: BackgroundTasks):
     # client_ip = request.client.host
     client_ip = args.client_ip
-    user_directory = os.path.join(os.path.abspath(config['DEFAULT']['UPLOAD_DIRECTORY']), client_ip)
-    output_dictionary = os.path.join(os.path.abspath(config['DEFAULT']['DOWNLOAD_DICTIONARY']), client_ip)
-    if os.path.exists(output_dictionary):
-        delete_folder_contents(output_dictionary)
+    check_task_id(client_ip)
+    if not is_language_pair_supported(args.source_lang, args.target_lang):
+        raise HTTPException(status_code=400, detail="Unsupported language")
+    user_directory = str(app.state.upload_dir / client_ip)
+    output_dictionary = str(app.state.download_dir / client_ip)
     try:
-        if task_manager.count_tasks() > int(config['DEFAULT']['MAX_TASKS']):
+        if task_manager.count_tasks() > app.state.max_tasks:
             raise HTTPException(status_code=555, detail=f"服务器繁忙请稍后重试")
         task_manager.add_task(client_ip)
+        # 清理旧的输出目录放到后台执行，后台任务按添加顺序执行，保证在翻译开始前完成
+        if os.path.exists(output_dictionary):
+            background_tasks.add_task(delete_folder_contents, output_dictionary)
         background_tasks.add_task(translate_folder_with_task_id,
                                   task_id=client_ip,
                                   input_folder=user_directory,
@@ -94,18 +152,18 @@ async def translate_files(request: Request, args: SourceRequest, background_task
                                   tgt_lang=args.target_lang,
                                   via_eng=args.via_eng
                                   )
-        logger.info(f"Successfully submit task from {client_ip}.")
+        logger.info("Successfully submit task from %s.", client_ip)
     except PackageNotFoundError as ee:
-        logger.error(f"{client_ip} translate files failed , {ee}.")
+        logger.error("%s translate files failed , %s.", client_ip, ee)
         raise HTTPException(status_code=501, detail=f"File not Found: {str(ee)}")
     except HTTPException as e:
-        logger.error(f"{client_ip} translate files failed , {e}.")
+        logger.error("%s translate files failed , %s.", client_ip, e)
         raise e
     except Exception as e:
-        logger.error(f"{client_ip} translate files failed , {e}.")
+        logger.error("%s translate files failed , %s.", client_ip, e)
         raise HTTPException(status_code=500, detail=f"An error occurred: {e.d}")
 
-    return JSONResponse(status_code=200, content={"task_id": client_ip})
+    return ORJSONResponse(status_code=200, content={"task_id": client_ip})
 
 
 # websocket接口翻译文本
@@ -117,59 +175,82 @@ async def websocket_translate(websocket: WebSocket):
         # 接收客户端消息
         data = await websocket.receive_text()
         try:
-            args = json.loads(data)
-        except json.JSONDecodeError:
-            await websocket.send_text(json.dumps({"error": "Invalid JSON format"}))
+            args = orjson.loads(data)
+        except orjson.JSONDecodeError:
+            await websocket.send_text(orjson.dumps({"error": "Invalid JSON format"}).decode())
             continue
 
         sentences = args.get("sentences")
-        result_data = translate_sentences(text=sentences, src_lang=args.get('source_lang'),
-                                          tgt_lang=args.get('target_lang'), via_eng=args.get('via_eng'))
+        src_lang, tgt_lang, via_eng = args.get('source_lang'), args.get('target_lang'), args.get('via_eng')
+        if not is_language_pair_supported(src_lang, tgt_lang):
+            await websocket.send_text(orjson.dumps({"error": "Unsupported language"}).decode())
+            continue
+        # 并发请求由批处理器合并后在线程池中推理，避免卡住事件循环；重复的行由translate_lines的行缓存直接返回
+        result_data = await batcher.submit(text=sentences, src_lang=src_lang, tgt_lang=tgt_lang, via_eng=via_eng)
         # 发送翻译结果给客户端
-        await websocket.send_text(json.dumps({"result": result_data, "error": ''}))
+        await websocket.send_text(orjson.dumps({"result": result_data, "error": ''}).decode())
 
 
 # 获取任务状态的接口
 @app.get("/task_status")
 async def get_task_status(task_id: str):
     status = task_manager.get_task_status(task_id)
+    # 该接口被客户端高频轮询，直接返回响应对象，跳过FastAPI的jsonable_encoder处理
     if status is None:
-        return {"task_id": task_id, "result": "No Task"}
-    return {"task_id": task_id, "result": status}
+        return ORJSONResponse(content={"task_id": task_id, "result": "No Task"})
+    return ORJSONResponse(content={"task_id": task_id, "result": status.value})
 
 
 @app.get("/download-all")
 async def download_all_files(task_id: str):
-    dir_path = Path(os.path.join(config['DEFAULT']['DOWNLOAD_DICTIONARY'], task_id))
+    check_task_id(task_id)
+    root = str(app.state.download_dir / task_id)
+    base = len(root) + 1
 
-    # 检查文件夹是否为空
-    if not any(dir_path.iterdir()):
-        raise HTTPException(status_code=404, detail="Directory is empty")
-
-    zip_path = dir_path / "all_files.zip"
-
-    # 清理之前的zip文件
-    if zip_path.exists():
-        zip_path.unlink()
+    # 同一次目录扫描既用于判断是否为空，也用于收集要打包的文件
+    try:
+        it = os.scandir(root)
+    except FileNotFoundError:
+        raise HTTPException(status_code=404, detail="Directory not found")
+    with it:
+        first = next(it, None)
+        if first is None:
+            raise HTTPException(status_code=404, detail="Directory is empty")
+        # 只有一个文件时直接返回该文件，不再打包
+        second = next(it, None)
+        if second is None and first.is_file():
+            logger.info("Start downloading all files from %s", task_id)
+            quoted_name = quote(first.name)
+            if quoted_name != first.name:
+                content_disposition = f"attachment; filename*=utf-8''{quoted_name}"
+            else:
+                content_disposition = f'attachment; filename="{first.name}"'
+            return StreamingResponse(iter_then_mark_downloaded(iter_file(first.path), task_id),
+                                     media_type=mimetypes.guess_type(first.name)[0] or "application/octet-stream",
+                                     headers={"Content-Disposition": content_disposition,
+                                              "Content-Length": str(first.stat().st_size)})
 
-    # 创建新的zip文件
-    with ZipFile(zip_path, 'w') as zipf:
-        for root, dirs, files in os.walk(dir_path):
-            for file in files:
-                file_path = Path(root) / file
-                zipf.write(file_path, file_path.relative_to(dir_path))
+        # 边打包边发送，不再在磁盘上生成zip文件
+        # docx/xlsx本身已是压缩格式，直接存储不再压缩，打包开销只剩磁盘读取
+        zip_stream = ZipStream(compress_type=ZIP_STORED, sized=True)
+        for entry in chain([first], [second] if second is not None else [], it):
+            if entry.is_dir(follow_symlinks=False):
+                for file_path in iter_files(entry.path):
+                    zip_stream.add_path(file_path, file_path[base:])
+            else:
+                zip_stream.add_path(entry.path, entry.path[base:])
 
-    if zip_path.exists():
-        logger.info(f"Successfully downloaded all files from {task_id}")
-        task_manager.update_task_status(task_id, TaskStatus.DOWNLOADED)
-        return FileResponse(zip_path, filename="all_files.zip")
-    else:
-        logger.error(f"Failed to download all files from {task_id}")
-        raise HTTPException(status_code=404, detail="ZIP file creation failed")
+    logger.info("Start downloading all files from %s", task_id)
+    # 传输完成后再标记为已下载，避免定时任务在传输过程中删除文件夹
+    return StreamingResponse(iter_then_mark_downloaded(zip_stream, task_id), media_type="application/zip",
+                             headers={"Content-Disposition": 'attachment; filename="all_files.zip"',
+                                      "Content-Length": str(len(zip_stream))})
 
 
 if __name__ == "__main__":
     import multiprocessing
 
     multiprocessing.freeze_support()
-    uvicorn.run(app="server:app", host="0.0.0.0", port=8000, log_level="info", workers=1)
+    # 模型单例和任务状态都保存在进程内存中，只支持单worker；loop/http为auto时已安装的uvloop、httptools会被自动选用
+    uvicorn.run(app="server:app", host="0.0.0.0", port=8000, log_level="info",
+                loop="auto", http="auto", ws="websockets", workers=1)
@@ -1,52 +1,105 @@
 import os
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 from utils.util import delete_folder_contents
+from utils.logging_config import logger
 from utils.taskManager import update_task_status
 from models.translateModel import TranslatorSingleton, DocxTranslator, TableTranslator
 
 
+LINE_CACHE_SIZE = 50000
+# 只缓存较短的行，单条超长输入不会占用缓存内存
+LINE_CACHE_MAX_CHARS = 512
+# 按行的翻译缓存，translate_lines在批处理器的工作线程中调用，需要加锁
+_line_cache = OrderedDict()
+_line_cache_lock = threading.Lock()
+
+
+_ESCAPE_TABLE = str.maketrans({"\r": r"\r", "\n": r"\n", "\t": r"\t"})
+
+
 def encode_string(text):
-    return text.replace("\r", r"\r").replace("\n", r"\n").replace("\t", r"\t")
+    return text.translate(_ESCAPE_TABLE)
+
+
+# 按行批量翻译，返回与输入一一对应的译文列表；命中缓存的行不再送入模型，未命中的行合并为一次调用
+def translate_lines(texts: list, src_lang: str, tgt_lang: str, via_eng: bool) -> list:
+    keys = [(src_lang, tgt_lang, bool(via_eng), text) for text in texts]
+    with _line_cache_lock:
+        results = [_line_cache.get(key) for key in keys]
+        for key, result in zip(keys, results):
+            if result is not None:
+                _line_cache.move_to_end(key)
+
+    misses = [text for text, result in zip(texts, results) if result is None]
+    if not misses:
+        return results
+
+    translated = dict(zip(misses, TranslatorSingleton.translate_batch(texts=misses,
+                                                                      src_lang=src_lang,
+                                                                      tgt_lang=tgt_lang,
+                                                                      via_eng=via_eng)))
+    with _line_cache_lock:
+        for text, result in translated.items():
+            if len(text) > LINE_CACHE_MAX_CHARS:
+                continue
+            key = (src_lang, tgt_lang, bool(via_eng), text)
+            _line_cache[key] = result
+            _line_cache.move_to_end(key)
+        while len(_line_cache) > LINE_CACHE_SIZE:
+            _line_cache.popitem(last=False)
 
+    return [translated[text] if result is None else result for text, result in zip(texts, results)]
 
-# 翻译函数，接受text、src_lang和tgt_lang参数
-def translate_sentences(text: str, src_lang: str, tgt_lang: str, via_eng: bool):
-    texts = text.split("\n")
-    translated_texts = TranslatorSingleton.translate_batch(texts=texts,
-                                                           src_lang=src_lang,
-                                                           tgt_lang=tgt_lang,
-                                                           via_eng=via_eng)
-    return '\n'.join(translated_texts)
+
+# 扩展名 -> 文件的 (读取, 翻译, 保存) 三个阶段
+_HANDLERS = {
+    ".docx": (DocxTranslator.load_docx, DocxTranslator.translate_document, DocxTranslator.save_docx),
+    ".xlsx": (TableTranslator.load_excel, TableTranslator.translate_workbook, TableTranslator.save_excel),
+    ".xls": (TableTranslator.load_excel, TableTranslator.translate_workbook, TableTranslator.save_excel),
+    ".csv": (TableTranslator.load_csv, TableTranslator.translate_dataframe, TableTranslator.save_csv),
+}
+
+
+def _save_translated(save, translated, input_path: str, output_path: str):
+    save(translated, output_path)
+    logger.info("Translated %s to %s", input_path, output_path)
 
 
 # 翻译文件夹中的所有docx文件
+# 读取、翻译、保存三段流水线：翻译第N个文件时，读线程预先解析第N+1个，写线程保存第N-1个，模型不再等待磁盘IO
 def translate_folder(input_folder: str, output_folder: str, src_lang: str, tgt_lang: str, via_eng: bool = False):
     if not os.path.exists(output_folder):
         os.makedirs(output_folder)
 
-    for filename in os.listdir(input_folder):
-        input_path = os.path.join(input_folder, filename)
-        output_path = os.path.join(output_folder, f"translated_{filename}")
-
-        if filename.endswith(".docx"):
-            DocxTranslator.translate_docx(input_path=input_path,
-                                          output_path=output_path,
-                                          src_lang=src_lang,
-                                          tgt_lang=tgt_lang,
-                                          via_eng=via_eng)
-        elif filename.endswith((".xlsx", ".xls")):
-            TableTranslator.translate_excel(input_path=input_path,
-                                            output_path=output_path,
-                                            src_lang=src_lang,
-                                            tgt_lang=tgt_lang,
-                                            via_eng=via_eng)
-        elif filename.endswith(".csv"):
-            TableTranslator.translate_csv(input_path=input_path,
-                                          output_path=output_path,
-                                          src_lang=src_lang,
-                                          tgt_lang=tgt_lang,
-                                          via_eng=via_eng)
-
-        print(f"Translated {input_path} to {output_path}")
+    # 流水线需要预读下一个文件，因此仍收集为列表；扫描时每个条目只计算一次扩展名
+    jobs = []
+    with os.scandir(input_folder) as it:
+        for entry in it:
+            stages = _HANDLERS.get(os.path.splitext(entry.name)[1].lower())
+            if stages is not None:
+                jobs.append((entry.path, os.path.join(output_folder, f"translated_{entry.name}"), stages))
+    if not jobs:
+        return
+
+    with ThreadPoolExecutor(max_workers=1) as reader, ThreadPoolExecutor(max_workers=1) as writer:
+        pending_load = reader.submit(jobs[0][2][0], jobs[0][0])
+        pending_save = None
+        for i, (input_path, output_path, (_, translate, save)) in enumerate(jobs):
+            loaded = pending_load.result()
+            if i + 1 < len(jobs):
+                next_path, _, (load, _, _) = jobs[i + 1]
+                pending_load = reader.submit(load, next_path)
+
+            translated = translate(loaded, src_lang=src_lang, tgt_lang=tgt_lang, via_eng=via_eng)
+
+            # 最多只保留一个待写入的文件，避免已翻译的文档在内存中堆积
+            if pending_save is not None:
+                pending_save.result()
+            pending_save = writer.submit(_save_translated, save, translated, input_path, output_path)
+
+        pending_save.result()
 
 
 # 带有task_id的翻译文件夹函数
@@ -59,8 +112,8 @@ def translate_folder_with_task_id(task_id: str, input_folder: str, output_folder
                          src_lang=src_lang,
                          tgt_lang=tgt_lang,
                          via_eng=via_eng)
-    except Exception as e:
-        print(e)
+    except Exception:
+        logger.exception("Failed to translate folder %s", input_folder)
     finally:
         delete_folder_contents(input_folder)
         os.rmdir(input_folder)
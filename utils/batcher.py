@@ -0,0 +1,83 @@
+import asyncio
+from contextlib import suppress
+from configparser import ConfigParser
+
+cfg = ConfigParser()
+cfg.read('./config/config.ini')
+
+
+# 动态批处理器：在很短的时间窗口内收集并发的翻译请求，按语言对合并为一次模型调用
+class TranslationBatcher:
+    def __init__(self, max_batch_size: int, max_wait_ms: int):
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait_ms / 1000
+        self._translate_fn = None
+        self._queue = None
+        self._worker = None
+        self._dispatching = set()
+
+    def start(self, translate_fn):
+        """translate_fn(texts, src_lang, tgt_lang, via_eng) -> list，按行翻译的同步函数"""
+        self._translate_fn = translate_fn
+        self._queue = asyncio.Queue()
+        self._worker = asyncio.create_task(self._run())
+
+    async def stop(self):
+        self._worker.cancel()
+        with suppress(asyncio.CancelledError):
+            await self._worker
+
+    async def submit(self, text: str, src_lang: str, tgt_lang: str, via_eng: bool) -> str:
+        future = asyncio.get_running_loop().create_future()
+        await self._queue.put((text.split("\n"), (src_lang, tgt_lang, bool(via_eng)), future))
+        return await future
+
+    async def _collect(self) -> list:
+        loop = asyncio.get_running_loop()
+        batch = [await self._queue.get()]
+        size = len(batch[0][0])
+        deadline = loop.time() + self.max_wait
+        while size < self.max_batch_size:
+            timeout = deadline - loop.time()
+            if timeout <= 0:
+                break
+            try:
+                item = await asyncio.wait_for(self._queue.get(), timeout)
+            except asyncio.TimeoutError:
+                break
+            batch.append(item)
+            size += len(item[0])
+        return batch
+
+    async def _dispatch(self, key: tuple, items: list):
+        src_lang, tgt_lang, via_eng = key
+        texts = [line for lines, _, _ in items for line in lines]
+        try:
+            translated = await asyncio.to_thread(self._translate_fn, texts, src_lang, tgt_lang, via_eng)
+        except Exception as e:
+            for _, _, future in items:
+                if not future.done():
+                    future.set_exception(e)
+            return
+
+        offset = 0
+        for lines, _, future in items:
+            # 客户端断开时future会被取消
+            if not future.done():
+                future.set_result('\n'.join(translated[offset:offset + len(lines)]))
+            offset += len(lines)
+
+    async def _run(self):
+        while True:
+            groups = {}
+            for item in await self._collect():
+                groups.setdefault(item[1], []).append(item)
+            # 各语言对的批次并发下发，由模型实例的信号量控制并发度
+            for key, items in groups.items():
+                task = asyncio.create_task(self._dispatch(key, items))
+                self._dispatching.add(task)
+                task.add_done_callback(self._dispatching.discard)
+
+
+batcher = TranslationBatcher(max_batch_size=cfg['DEFAULT'].getint('BATCH_MAX_SIZE', 32),
+                             max_wait_ms=cfg['DEFAULT'].getint('BATCH_MAX_WAIT_MS', 10))
@@ -1,61 +1,79 @@
 # file_handler.py
 import os
-from io import BytesIO
-from docx import Document
+import shutil
+import asyncio
+import zipfile
+import aiofiles
 from typing import List
 from fastapi import UploadFile, HTTPException
 import pandas as pd
 
 
 class FileHandler:
-    @classmethod
-    def _save_docx(cls, file: UploadFile, directory: str) -> None:
+    @staticmethod
+    def _validate_docx(path: str) -> None:
+        # docx本身是zip包，只校验压缩包完整性，不再用python-docx解析后重新保存
         try:
-            file_stream = BytesIO(file.file.read())
-            document = Document(file_stream)
-            new_file_location = os.path.join(directory, file.filename)
-            document.save(new_file_location)
-        finally:
-            file_stream.close()
-
+            with zipfile.ZipFile(path) as zf:
+                if zf.testzip() is None:
+                    return
+        except zipfile.BadZipFile:
+            pass
+        raise ValueError("File is not a valid docx document")
 
-    @classmethod
-    def _save_excel(cls, file: UploadFile, directory: str) -> None:
-        try:
-            file_stream = BytesIO(file.file.read())
-            df = pd.read_excel(file_stream)
-            new_file_location = os.path.join(directory, file.filename)
-            df.to_excel(new_file_location, index=False)
-        except Exception as e:
-            raise e
-        finally:
-            file_stream.close()
+    @staticmethod
+    def _validate_excel(path: str) -> None:
+        pd.read_excel(path, nrows=0)
 
+    @staticmethod
+    def _validate_csv(path: str) -> None:
+        pd.read_csv(path, nrows=1)
 
     @classmethod
-    def _save_csv(cls, file: UploadFile, directory: str) -> None:
+    async def _save_file(cls, file: UploadFile, directory: str, max_file_size: int) -> None:
+        new_file_location = os.path.join(directory, file.filename)
+        if file.filename.endswith('.docx'):
+            validator = cls._validate_docx
+        elif file.filename.endswith(('.xlsx', '.xls')):
+            validator = cls._validate_excel
+        else:
+            validator = cls._validate_csv
+
+        # 超限或校验失败时直接抛出，由process_files删除整个请求目录并停止保存其余文件
         try:
-            file_stream = BytesIO(file.file.read())
-            df = pd.read_csv(file_stream)
-            new_file_location = os.path.join(directory, file.filename)
-            df.to_csv(new_file_location, index=False)
-        finally:
-            file_stream.close()
+            # 分块写入磁盘，内存占用与文件大小无关；边写边统计大小，超限立即中止
+            written = 0
+            async with aiofiles.open(new_file_location, "wb") as out:
+                while chunk := await file.read(1 << 20):
+                    written += len(chunk)
+                    if written > max_file_size:
+                        raise HTTPException(status_code=413, detail=f"File too large: {file.filename}")
+                    await out.write(chunk)
+            await asyncio.to_thread(validator, new_file_location)
+        except HTTPException:
+            raise
+        except Exception as e:
+            raise HTTPException(status_code=500, detail=f"Error processing file {file.filename}: {str(e)}")
 
     @classmethod
-    def process_files(cls, upload_directory: str, files: List[UploadFile]) -> None:
-        os.makedirs(upload_directory, exist_ok=True)
-
+    async def process_files(cls, upload_directory: str, files: List[UploadFile], max_file_size: int) -> None:
         for file in files:
             if not file.filename.endswith(('.docx', '.xlsx', '.xls', '.csv')):
                 raise HTTPException(status_code=400, detail=f"Unsupported file type: {file.filename}")
+            if file.size is not None and file.size > max_file_size:
+                raise HTTPException(status_code=413, detail=f"File too large: {file.filename}")
+
+        # 同名文件会写入同一路径，直接拒绝
+        if len({file.filename for file in files}) < len(files):
+            raise HTTPException(status_code=400, detail="Duplicate file names in upload")
 
-            try:
-                if file.filename.endswith('.docx'):
-                    cls._save_docx(file, upload_directory)
-                elif file.filename.endswith(('.xlsx', '.xls')):
-                    cls._save_excel(file, upload_directory)
-                elif file.filename.endswith('.csv'):
-                    cls._save_csv(file, upload_directory)
-            except Exception as e:
-                raise HTTPException(status_code=500, detail=f"Error processing file {file.filename}: {str(e)}")
+        # 上传根目录在启动时已创建，每次请求的目录名都是新的uuid，只需创建这一层
+        os.mkdir(upload_directory)
+
+        # 逐个落盘：任一文件失败时不再继续写入其余文件，并删除整个请求目录，避免残留无主文件
+        try:
+            for file in files:
+                await cls._save_file(file, upload_directory, max_file_size)
+        except Exception:
+            shutil.rmtree(upload_directory, ignore_errors=True)
+            raise
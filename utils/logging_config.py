@@ -1,6 +1,8 @@
+import atexit
 import logging
 import logging.handlers
 import os
+import queue
 
 # 创建日志目录
 log_dir = './logs'
@@ -12,13 +14,24 @@ LOG_LEVEL = logging.INFO
 LOG_FORMAT = '%(asctime)s - %(name)s - %(levelname)s - %(message)s'
 LOG_FILE = os.path.join(log_dir, 'app.log')
 
+formatter = logging.Formatter(LOG_FORMAT)
+file_handler = logging.FileHandler(LOG_FILE)
+file_handler.setFormatter(formatter)
+stream_handler = logging.StreamHandler()
+stream_handler.setFormatter(formatter)
+
+# 业务线程只把日志记录放入队列，由监听线程统一写文件和控制台，避免在请求/翻译线程上争用文件锁
+log_queue = queue.Queue(-1)
+listener = logging.handlers.QueueListener(log_queue, file_handler, stream_handler, respect_handler_level=True)
+listener.start()
+atexit.register(listener.stop)
+
+queue_handler = logging.handlers.QueueHandler(log_queue)
+# 最终格式由监听端的处理器负责，这里只合并消息参数
+queue_handler.setFormatter(logging.Formatter('%(message)s'))
 logging.basicConfig(
     level=LOG_LEVEL,
-    format=LOG_FORMAT,
-    handlers=[
-        logging.FileHandler(LOG_FILE),
-        logging.StreamHandler()
-    ]
+    handlers=[queue_handler]
 )
 
 logger = logging.getLogger(__name__)
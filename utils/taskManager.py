@@ -1,5 +1,6 @@
 # task_manager.py
 import os
+import threading
 from enum import Enum
 
 from utils.util import delete_folder_contents
@@ -16,30 +17,46 @@ class TaskStatus(str, Enum):
 
 # 任务管理器类
 class TaskManager:
+    ACTIVE_STATUSES = (TaskStatus.QUEUED, TaskStatus.IN_PROGRESS)
+
     def __init__(self):
         self.tasks = {}
+        # 排队中和执行中的任务数，随状态变化增量维护；状态会在后台线程中更新，需加锁
+        self._active = 0
+        self._lock = threading.Lock()
+
+    def _set_status(self, task_id: str, status: TaskStatus):
+        previous = self.tasks.get(task_id)
+        self._active += (status in self.ACTIVE_STATUSES) - (previous in self.ACTIVE_STATUSES)
+        self.tasks[task_id] = status
 
     def add_task(self, task_id: str):
-        self.tasks[task_id] = TaskStatus.QUEUED
+        with self._lock:
+            self._set_status(task_id, TaskStatus.QUEUED)
 
     def update_task_status(self, task_id: str, status: TaskStatus):
-        if task_id in self.tasks:
-            self.tasks[task_id] = status
-        else:
-            raise ValueError("Task ID not found")
+        with self._lock:
+            if task_id in self.tasks:
+                self._set_status(task_id, status)
+            else:
+                raise ValueError("Task ID not found")
 
     def get_task_status(self, task_id: str) -> None:
         return self.tasks.get(task_id, None)
 
     def count_tasks(self):
-        return len([1 for _, status in self.tasks.items() if status == TaskStatus.QUEUED or status == TaskStatus.IN_PROGRESS])
+        return self._active
 
     def delete_task_status(self, task_id: str) -> None:
-        del self.tasks[task_id]
+        with self._lock:
+            status = self.tasks.pop(task_id)
+            self._active -= status in self.ACTIVE_STATUSES
 
     def delete_downloaded_task_folders(self, download_directory: str):
         """删除状态为'已下载'的任务文件夹"""
-        to_delete = [task_id for task_id, status in self.tasks.items() if status == TaskStatus.DOWNLOADED or status == TaskStatus.FAILED]
+        # 在调度器线程中执行，遍历前在锁内复制，避免与add_task/状态更新并发修改字典
+        with self._lock:
+            to_delete = [task_id for task_id, status in self.tasks.items() if status == TaskStatus.DOWNLOADED or status == TaskStatus.FAILED]
         for task_id in to_delete:
             folder_path = os.path.join(download_directory, task_id)
             if os.path.exists(folder_path) and os.path.isdir(folder_path):
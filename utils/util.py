@@ -28,6 +28,16 @@ def delete_folder_contents(folder_path):
             os.rmdir(file_path)
 
 
+def iter_files(folder_path: str):
+    """递归遍历文件夹，依次返回其中所有文件的路径"""
+    with os.scandir(folder_path) as it:
+        for entry in it:
+            if entry.is_dir(follow_symlinks=False):
+                yield from iter_files(entry.path)
+            else:
+                yield entry.path
+
+
 def delete_folder(folder_path: Path):
     """删除文件夹中的所有内容"""
     for item in folder_path.iterdir():